@@ -12,7 +12,7 @@ setup(name='trafikanten',
       url=trafikanten.__url__,
       packages=['trafikanten'],
       license=trafikanten.__license__,
-      scripts=['scripts/tf_search', 'scripts/tf_realtime'],
+      scripts=['scripts/tf_search', 'scripts/tf_realtime', 'scripts/tf_serve'],
       classifiers=[
           'License :: OSI Approved :: BSD License',
           'Intended Audience :: Developers',
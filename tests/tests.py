@@ -8,6 +8,13 @@ import types
 import trafikanten
 import trafikanten.util
 import time
+import tempfile
+import shutil
+import imp
+import threading
+import urllib2
+import StringIO
+import hashlib
 
 def smoke_test_realtime_parser():
     folder = "tests/sample_realtime"
@@ -120,3 +127,390 @@ def test_invalid_station_id():
 def test_unicode_term_handling():
     term = u"østerås"
     assert trafikanten.find_station(term)
+
+def test_memory_cache_realtime():
+    calls = []
+    def fake_get_realtime(sid, raise_errors=False):
+        calls.append(sid)
+        return []
+
+    orig = trafikanten.get_realtime
+    trafikanten.get_realtime = fake_get_realtime
+    try:
+        tf = trafikanten.MemoryCacheTrafikanten()
+        assert tf.get_realtime("03012370") == []
+        tf._cache_realtime("03012370", [{"id": u"1"}])
+        assert tf.get_realtime("03012370") == [{"id": u"1"}]
+        assert calls == ["03012370"]
+    finally:
+        trafikanten.get_realtime = orig
+
+def test_memory_cache_negative():
+    calls = []
+    def fake_get_realtime(sid, raise_errors=False):
+        calls.append(sid)
+        raise trafikanten.UnknownStationError(sid)
+
+    orig = trafikanten.get_realtime
+    trafikanten.get_realtime = fake_get_realtime
+    try:
+        tf = trafikanten.MemoryCacheTrafikanten(negative_expiry_time=10)
+        assert tf.get_realtime("does_not_exist") == None
+        assert tf.get_realtime("does_not_exist") == None
+        assert calls == ["does_not_exist"]
+
+        try:
+            tf.get_realtime("does_not_exist", raise_errors=True)
+            assert False, "Expected UnknownStationError"
+        except trafikanten.UnknownStationError:
+            pass
+        assert calls == ["does_not_exist"]
+
+        tf.negative_expiry_time = 0
+        assert tf.get_realtime("does_not_exist") == None
+        assert calls == ["does_not_exist", "does_not_exist"]
+    finally:
+        trafikanten.get_realtime = orig
+
+def test_realtime_parser_not_acknowledged():
+    s = """<?xml version="1.0"?><DataSupplyAnswer xmlns="vdv453eng">
+<Acknowledge TimeStamp="2008-12-03T00:04:28.275+01:00" Result="notok"
+ErrorNumber="1"/></DataSupplyAnswer>"""
+    assert trafikanten.api._parse_realtime_data(s) == None
+
+def test_memory_cache_search_prefix_reuse():
+    calls = []
+    stations = [{"id": u"1", "name": u"Birkelunden"},
+                {"id": u"2", "name": u"Bislett"},
+                {"id": u"3", "name": u"Kjølberggata"}]
+    def fake_find_station(term, raise_errors=False):
+        if not term:
+            raise trafikanten.UnknownStationError("Empty search term")
+        calls.append(term)
+        folded = term.lower()
+        return [e for e in stations if folded in e["name"].lower()]
+
+    orig = trafikanten.find_station
+    trafikanten.find_station = fake_find_station
+    try:
+        tf = trafikanten.MemoryCacheTrafikanten(reuse_search_prefixes=True)
+        assert tf.find_station(u"b") == stations
+        assert tf.find_station(u"bi") == stations[:2]
+        assert tf.find_station(u"bir") == stations[:1]
+        assert tf.find_station(u"birk") == stations[:1]
+        assert tf.find_station(u"birx") == []
+        assert calls == [u"b"]
+
+        assert tf.find_station(u"Kj") == stations[2:]
+        assert tf.find_station(u"KJØLB") == stations[2:]
+        assert tf.find_station(u"BIR") == stations[:1]
+        assert calls == [u"b", u"kj"]
+
+        assert tf.find_station(None) == None
+        assert tf.find_station(u"") == None
+
+        # derived results expire together with the result they came from
+        tf._search_cache[u"b"] = (time.time() - 3599, stations)
+        tf._search_cache.pop(u"bi")
+        tf.find_station(u"bi")
+        assert tf._search_cache[u"bi"][0] == tf._search_cache[u"b"][0]
+
+        # a result at the limit may be truncated, so it can't be reused
+        tf = trafikanten.MemoryCacheTrafikanten(reuse_search_prefixes=True,
+                                                search_result_limit=2)
+        tf.find_station(u"b")
+        tf.find_station(u"bi")
+        assert calls == [u"b", u"kj", u"b", u"bi"]
+    finally:
+        trafikanten.find_station = orig
+
+def test_file_cache_realtime():
+    tf = trafikanten.FileCacheTrafikanten()
+    tf._cache_realtime("03012370", [{"id": u"1"}])
+    assert tf._get_cached_realtime("03012370") == [{"id": u"1"}]
+    assert tf._get_cached_search("03012370") == None
+
+def test_tiered_cache():
+    calls = []
+    def fake_get_realtime(sid, raise_errors=False):
+        calls.append(sid)
+        return [{"id": u"1"}]
+
+    orig = trafikanten.get_realtime
+    trafikanten.get_realtime = fake_get_realtime
+    cache_loc = tempfile.mkdtemp()
+    try:
+        tf = trafikanten.TieredCacheTrafikanten(cache_loc=cache_loc)
+        tf.get_realtime("03012370")
+        tf.get_realtime("03012370")
+        assert tf.stats == {"l1_hits": 1, "l2_hits": 0, "misses": 1}
+
+        # a second process sharing the disk cache
+        tf = trafikanten.TieredCacheTrafikanten(cache_loc=cache_loc)
+        assert tf.get_realtime("03012370") == [{"id": u"1"}]
+        assert tf.get_realtime("03012370") == [{"id": u"1"}]
+        assert tf.stats == {"l1_hits": 1, "l2_hits": 1, "misses": 0}
+        assert calls == ["03012370"]
+
+        # data copied into l1 keeps the age it had in l2
+        old = time.time() - 19
+        tf.l2._cache_realtime("03012371", [], old)
+        tf.get_realtime("03012371")
+        assert tf.l1._realtime_cache["03012371"][0] == int(old)
+        tf.l2._cache_realtime("03012372", [], time.time() - 30)
+        tf.get_realtime("03012372")
+        assert calls == ["03012370", "03012372"]
+    finally:
+        trafikanten.get_realtime = orig
+        shutil.rmtree(cache_loc)
+
+def test_tiered_cache_options():
+    tf = trafikanten.TieredCacheTrafikanten(realtime_expiry_time=60,
+                                            search_expiry_time=120)
+    assert tf.l2.realtime_expiry_time == 60
+    assert tf.l2.search_expiry_time == 120
+    assert tf.l1.realtime_expiry_time == 5
+    assert tf.l1.search_expiry_time == 120
+
+def test_tiered_cache_stats():
+    calls = []
+    def fake_find_station(term, raise_errors=False):
+        calls.append(term)
+        raise trafikanten.UpstreamError(term)
+
+    orig = trafikanten.find_station
+    trafikanten.find_station = fake_find_station
+    try:
+        tf = trafikanten.TieredCacheTrafikanten(reuse_search_prefixes=True,
+                                                negative_expiry_time=0)
+        tf.find_station(u"birkelu")
+        assert tf.stats == {"l1_hits": 0, "l2_hits": 0, "misses": 1}
+        # the cached error has expired, so this goes upstream again
+        tf.find_station(u"birkelu")
+        assert tf.stats == {"l1_hits": 0, "l2_hits": 0, "misses": 2}
+        assert calls == [u"birkelu", u"birkelu"]
+    finally:
+        trafikanten.find_station = orig
+
+def test_file_cache_shared_files():
+    tf = trafikanten.FileCacheTrafikanten()
+    umask = os.umask(0)
+    os.umask(umask)
+    tf._cache_search(u"kjølb", [])
+    names = os.listdir(tf.cache_location)
+    assert names == ["search_" + hashlib.md5(u"kjølb".encode("utf-8")).hexdigest()]
+    mode = os.stat(os.path.join(tf.cache_location, names[0])).st_mode
+    assert mode & 0777 == 0666 & ~umask
+
+def test_memory_cache_max_entries():
+    tf = trafikanten.MemoryCacheTrafikanten(max_entries=2)
+    tf._cache_search(u"a", [])
+    tf._cache_search(u"b", [])
+    tf._cache_search(u"c", [])
+    assert tf._get_cached_search(u"a") == None
+    assert tf._get_cached_search(u"b") == []
+    assert tf._get_cached_search(u"c") == []
+
+    tf = trafikanten.MemoryCacheTrafikanten(realtime_expiry_time=0)
+    tf._cache_realtime("03012370", [])
+    tf._cache_realtime("03012371", [])
+    assert len(tf._realtime_cache) == 1
+
+def _load_tf_serve():
+    return imp.load_source("tf_serve", "scripts/tf_serve")
+
+def test_tf_serve_coalescing():
+    tf_serve = _load_tf_serve()
+    calls = []
+    class SlowCache(object):
+        def get_realtime(self, sid):
+            calls.append(sid)
+            time.sleep(0.2)
+            return []
+
+    cache = tf_serve.CoalescingCache(SlowCache())
+    running = []
+    def lookup():
+        running.append(cache.get_realtime("03012370"))
+
+    threads = [threading.Thread(target=lookup) for i in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    # the others are waiting on the first lookup to finish
+    assert calls == ["03012370"]
+    for t in threads:
+        t.join()
+    assert running == [[], [], []]
+    assert cache._key_locks == {}
+
+def test_tf_serve_coalescing_folds_terms():
+    tf_serve = _load_tf_serve()
+    calls = []
+    def fake_find_station(term, raise_errors=False):
+        calls.append(term)
+        time.sleep(0.2)
+        return []
+
+    orig = trafikanten.find_station
+    trafikanten.find_station = fake_find_station
+    try:
+        cache = tf_serve.CoalescingCache(
+            trafikanten.MemoryCacheTrafikanten(reuse_search_prefixes=True))
+        threads = [threading.Thread(target=cache.find_station, args=(term,))
+                   for term in (u"Birk", u"birk", u"BIRK")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert calls == [u"birk"]
+    finally:
+        trafikanten.find_station = orig
+
+def _http_status(url, headers={}):
+    try:
+        return urllib2.urlopen(urllib2.Request(url, headers=headers)).code
+    except urllib2.HTTPError, e:
+        return e.code
+
+def test_tf_serve_handler():
+    tf_serve = _load_tf_serve()
+    def fake_get_realtime(sid, raise_errors=False):
+        if sid == "00000000":
+            raise trafikanten.UnknownStationError(sid)
+        if sid == "99999999":
+            raise trafikanten.UpstreamError(sid)
+        return [{"id": u"12", "time": time.localtime(), "wait_time": 60,
+                 "is_realtime": True}]
+    def fake_find_station(term, raise_errors=False):
+        return [{"id": u"03012370", "name": term}]
+
+    orig = trafikanten.get_realtime, trafikanten.find_station
+    trafikanten.get_realtime = fake_get_realtime
+    trafikanten.find_station = fake_find_station
+    server = tf_serve.ThreadingHTTPServer(("127.0.0.1", 0),
+                                          tf_serve.TrafikantenRequestHandler)
+    server.cache = tf_serve.CoalescingCache(
+        trafikanten.MemoryCacheTrafikanten())
+    server.quiet = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+    try:
+        res = urllib2.urlopen(base + "/realtime?sid=03012370")
+        etag = res.info()["ETag"]
+        assert '"id": "12"' in res.read()
+        assert _http_status(base + "/realtime?sid=03012370",
+                            {"If-None-Match": etag}) == 304
+        assert _http_status(base + "/realtime?sid=03012370",
+                            {"If-None-Match": '"other"'}) == 200
+
+        res = urllib2.urlopen(base + "/search?term=%C3%B8ster")
+        assert '"name": "\\u00f8ster"' in res.read()
+
+        assert _http_status(base + "/realtime") == 400
+        assert _http_status(base + "/realtime?sid=1%26DISID=2") == 400
+        assert _http_status(base + "/realtime?sid=0301237") == 400
+        assert _http_status(base + "/search") == 400
+        assert _http_status(base + "/realtime?sid=00000000") == 404
+        assert _http_status(base + "/realtime?sid=99999999") == 502
+        assert _http_status(base + "/nothing") == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        trafikanten.get_realtime, trafikanten.find_station = orig
+
+def _fake_urlopen(data):
+    def urlopen(url):
+        if data == None:
+            raise IOError("socket error")
+        return StringIO.StringIO(data)
+    return urlopen
+
+def test_realtime_upstream_errors():
+    broken = """<?xml version="1.0"?><DataSupplyAnswer xmlns="vdv453eng">
+<Acknowledge TimeStamp="2008-12-03T00:04:28.275+01:00" Result="ok"
+ErrorNumber="0"/><DISMessage><DISDeviation><LineID>13</LineID>
+</DISDeviation></DISMessage></DataSupplyAnswer>"""
+
+    orig = trafikanten.api.urllib.urlopen
+    try:
+        for data in (None, "<not xml", "<Nothing/>", broken):
+            trafikanten.api.urllib.urlopen = _fake_urlopen(data)
+            assert trafikanten.get_realtime("03012370") == None
+            try:
+                trafikanten.get_realtime("03012370", raise_errors=True)
+                assert False, "Expected UpstreamError for %r" % data
+            except trafikanten.UpstreamError:
+                pass
+
+        for term in (u"", None):
+            assert trafikanten.find_station(term) == None
+            try:
+                trafikanten.find_station(term, raise_errors=True)
+                assert False, "Expected UnknownStationError"
+            except trafikanten.UnknownStationError:
+                pass
+
+        trafikanten.api.urllib.urlopen = _fake_urlopen("<TravelResponse>")
+        try:
+            trafikanten.find_station(u"birk", raise_errors=True)
+            assert False, "Expected UpstreamError"
+        except trafikanten.UpstreamError:
+            pass
+    finally:
+        trafikanten.api.urllib.urlopen = orig
+
+class DictCacheTrafikanten(trafikanten.CachingTrafikanten):
+    """A backend implementing only the four required methods"""
+    def __init__(self, **kwargs):
+        self.searches = {}
+        self.realtime = {}
+        trafikanten.CachingTrafikanten.__init__(self, **kwargs)
+
+    def _get_cached_search(self, term):
+        return self.searches.get(term)
+
+    def _cache_search(self, term, data):
+        self.searches[term] = data
+
+    def _get_cached_realtime(self, sid):
+        return self.realtime.get(sid)
+
+    def _cache_realtime(self, sid, data):
+        self.realtime[sid] = data
+
+def test_tiered_cache_minimal_tiers():
+    calls = []
+    def fake_get_realtime(sid, raise_errors=False):
+        calls.append(sid)
+        return [{"id": u"1"}]
+
+    orig = trafikanten.get_realtime
+    trafikanten.get_realtime = fake_get_realtime
+    try:
+        l2 = DictCacheTrafikanten()
+        tf = trafikanten.TieredCacheTrafikanten(l1=DictCacheTrafikanten(),
+                                                l2=l2)
+        assert tf.get_realtime("03012370") == [{"id": u"1"}]
+        assert tf.get_realtime("03012370") == [{"id": u"1"}]
+        assert tf.stats == {"l1_hits": 1, "l2_hits": 0, "misses": 1}
+
+        # an l2 with no created times in front of a memory l1
+        tf = trafikanten.TieredCacheTrafikanten(l2=l2)
+        assert tf.get_realtime("03012370") == [{"id": u"1"}]
+        assert tf.get_realtime("03012370") == [{"id": u"1"}]
+        assert tf.stats == {"l1_hits": 1, "l2_hits": 1, "misses": 0}
+        assert calls == ["03012370"]
+    finally:
+        trafikanten.get_realtime = orig
+
+def test_tiered_cache_l1_max_entries():
+    tf = trafikanten.TieredCacheTrafikanten(l1_max_entries=2)
+    for term in (u"a", u"b", u"c"):
+        tf._cache_search(term, [])
+    assert len(tf.l1._search_cache) == 2
+    assert tf._get_cached_search(u"a") == []
+    assert tf.stats["l2_hits"] == 1
+    assert len(tf.l1._search_cache) == 2
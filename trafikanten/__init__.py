@@ -11,11 +11,13 @@ and Akershus counties.
 :license: BSD, see LICENSE for details.
 """
 
-__version__ = '0.2'
+__version__ = '0.3'
 __author__ = 'Rune Halvorsen <runefh@gmail.com>'
 __url__ = 'http://bitbucket.org/runeh/pytrafikanten/'
 __license__ = 'BSD License'
 __docformat__ = 'restructuredtext'
 
 from .api import find_station, get_realtime
+from .api import TrafikantenError, UnknownStationError, UpstreamError
 from .classes import CachingTrafikanten, FileCacheTrafikanten, MemoryCacheTrafikanten
+from .classes import TieredCacheTrafikanten
@@ -4,6 +4,7 @@ import urllib
 import time
 import math
 import xml.dom.minidom as minidom
+from xml.parsers.expat import ExpatError
 from trafikanten import __version__ as version
 from util import utm_to_lat_lng
 
@@ -43,7 +44,31 @@ class TrafikantentURLopener(urllib.FancyURLopener):
 
 urllib._urlopener = TrafikantentURLopener()
 
-def find_station(term):
+class TrafikantenError(Exception):
+    """Base class for errors raised by lookups when raise_errors is true"""
+
+class UnknownStationError(TrafikantenError):
+    """Raised when trafikanten does not know the requested station"""
+
+class UpstreamError(TrafikantenError):
+    """Raised when trafikanten could not be reached or returned data that
+    could not be parsed"""
+
+def _fetch(url, parse):
+    """Read url, and return the result of calling parse on the data. Raises
+    UpstreamError if the url can't be read, or if the data isn't what parse
+    expects."""
+    try:
+        data = urllib.urlopen(url).read()
+    except IOError, e:
+        raise UpstreamError("%s: %s" % (url, e))
+
+    try:
+        return parse(data)
+    except (ExpatError, KeyError, IndexError, ValueError), e:
+        raise UpstreamError("%s: unexpected data: %r" % (url, e))
+
+def find_station(term, raise_errors=False):
     """Search for stations matching term.
     Returns a list of dicts of the form:
     match = {
@@ -54,15 +79,21 @@ def find_station(term):
         "ycoord"; "0"
     }
     If no matches where found, the list has length 0. If the search did not
-    complete successfully, return None.
+    complete successfully, return None. If raise_errors is true, raises
+    UnknownStationError if term is empty and UpstreamError if trafikanten
+    could not be reached.
     """
-    if not term:
+    try:
+        if not term:
+            raise UnknownStationError("Empty search term")
+
+        url = _station_url % urllib.quote(term.encode("utf-8"))
+        return _fetch(url, _parse_station_data)
+    except TrafikantenError:
+        if raise_errors:
+            raise
         return None
 
-    url = _station_url % urllib.quote(term.encode("utf-8"))
-    data = urllib.urlopen(url).read()
-    return _parse_station_data(data)
-
 def _get_text(nodelist):
     """Stupid helper for dom. give me .textContent plx
     Returns the contcatentated contents of all text nodes in nodelist"""
@@ -105,31 +136,39 @@ def add_lat_lng_to_entry(entry):
     """Adds a lat and lng for x and y (which is another coordinate system)"""
     entry["lat"], entry["lng"] = utm_to_lat_lng(int(entry['xcoord']), int(entry['ycoord']))
 
-def get_realtime(sid):
+def get_realtime(sid, raise_errors=False):
     """Get realtime data for station with id "sid". Returns a list of
     dictionaries. If no realtime data is found, the returned list will be
     empty. If the station doesn't exist, or any other error occurs, returns
-    None.
+    None. If raise_errors is true, raises UnknownStationError if the station
+    doesn't exist and UpstreamError if trafikanten could not be reached.
     """
-    if not sid:
-        return None
-
-    if sid in _subway_stations:
-        url = _subway_rt_url % sid
-    else:
-        url = _non_subway_rt_url % sid
-
-    data = urllib.urlopen(url).read()
-    result = _parse_realtime_data(data)
+    try:
+        if not sid:
+            raise UnknownStationError("Empty station id")
 
-    if result:
-        result.sort(key=lambda e: int(e["wait_time"]))
+        if sid in _subway_stations:
+            url = _subway_rt_url % sid
+        else:
+            url = _non_subway_rt_url % sid
+
+        result = _fetch(url, _parse_realtime_data)
+        if result == None:
+            raise UnknownStationError(sid)
+    except TrafikantenError:
+        if raise_errors:
+            raise
+        return None
 
+    result.sort(key=lambda e: int(e["wait_time"]))
     return result
 
 def _parse_realtime_data(xmlstr):
     """
     Takes xml a string and returns a list of dicts containing realtime data.
+    Returns None if trafikanten did not acknowledge the request. Raises
+    ValueError if the data has no acknowledgement at all, or a departure
+    has no departure time.
     """
     doc = minidom.parseString(xmlstr)
     ret = []
@@ -137,7 +176,9 @@ def _parse_realtime_data(xmlstr):
                 "DestinationStop": "destination" }
 
     ack = _single_element(doc, "Acknowledge")
-    if ack == None or ack.attributes["Result"].nodeValue != "ok":
+    if ack == None:
+        raise ValueError("No Acknowledge element in realtime data")
+    if ack.attributes["Result"].nodeValue != "ok":
         return None
 
     curtime = time.mktime(time.strptime(
@@ -158,6 +199,8 @@ def _parse_realtime_data(xmlstr):
             timeele = _single_element(elem, "ExpectedDISDepartureTime")
         else:
             timeele = _single_element(elem, "ScheduledDISDepartureTime")
+        if timeele == None:
+            raise ValueError("No departure time in realtime data")
 
         parsed_time = time.strptime(
             _get_text(timeele.childNodes)[:-10], "%Y-%m-%dT%H:%M:%S")
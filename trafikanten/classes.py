@@ -6,8 +6,36 @@ import os
 import stat
 import time
 import pickle
+import hashlib
 import trafikanten
 import inspect
+import unicodedata
+import collections
+import threading
+
+# mkstemp creates files only we can read, while other processes sharing a
+# FileCacheTrafikanten folder may need to. Its files get the mode open()
+# would give them. The umask can only be read by setting it, so this is done
+# once, at import.
+_umask = os.umask(0)
+os.umask(_umask)
+_file_mode = 0666 & ~_umask
+
+def _fold(text):
+    """Normalize text for case insensitive comparison, so that for instance
+    "KJØLB" and "kjølb" compare equal, and so do an "å" written as one
+    character and one written as "a" followed by a combining ring."""
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return unicodedata.normalize("NFKC", text).lower()
+
+class CachedError(object):
+    """Stored in the cache in place of data when a lookup fails, so that
+    failing lookups are cached too. Remembers when it was created so it can
+    expire on its own schedule, independent of the backend."""
+    def __init__(self, error):
+        self.error = error
+        self.time = time.time()
 
 class CachingTrafikanten(object):
     """Superclass for classes that want to wrap around trafikanten while
@@ -22,33 +50,122 @@ class CachingTrafikanten(object):
     - _cache_realtime: same as _cache_search for realtime data
     The data returned from the _get_* methods should be the same as what is
     returned from trafikanten.find_station and trafikanten.get_realtime.
+    Subclasses that know when their data was cached should also implement
+    _get_search_entry and _get_realtime_entry, and take an optional created
+    argument to the _cache_* methods, giving the time the data was fetched.
+    Failed lookups are cached as CachedError objects, and should be stored
+    and returned like any other data. They expire after negative_expiry_time,
+    or earlier if the backend expires them first.
+    If reuse_search_prefixes is true, a search that is not cached is answered
+    by filtering the cached results for the longest cached prefix of the
+    term, as long as that result has fewer than search_result_limit entries
+    and so can't have been truncated by trafikanten. This saves a round trip
+    per keystroke for autocomplete style searches. The filtered result
+    expires together with the result it was made from. Filtering only keeps
+    stations whose name contains the term. This can differ from what
+    trafikanten returns, which may match stations on more than the name. Search terms are
+    case folded, and backends must implement _get_search_entry.
     """
-    def __init__(self, search_expiry_time=3600, realtime_expiry_time=20):
+    def __init__(self, search_expiry_time=3600, realtime_expiry_time=20,
+                 negative_expiry_time=10, reuse_search_prefixes=False,
+                 search_result_limit=40):
         self.search_expiry_time = search_expiry_time
         self.realtime_expiry_time = realtime_expiry_time
+        self.negative_expiry_time = negative_expiry_time
+        self.reuse_search_prefixes = reuse_search_prefixes
+        self.search_result_limit = search_result_limit
 
-    def find_station(self, term):
+    def find_station(self, term, raise_errors=False):
         """Identical arguments and return value as trafikanten.find_station.
         Will call _get_cached_search and _cache_search to handle caching
         properly. Subclasses probably do not need to override this method."""
-        data = self._get_cached_search(term)
-        if data == None:
-            data = trafikanten.find_station(term)
-            self._cache_search(term, data)
+        if self.reuse_search_prefixes and term:
+            derive = self._search_from_prefix
+        else:
+            derive = None
+        return self._lookup(self.search_key(term), raise_errors,
+                            trafikanten.find_station, self._get_cached_search,
+                            self._cache_search, derive)
 
-        return data
+    def search_key(self, term):
+        """Return the key the result of searching for term is cached under.
+        Searches with the same key are answered by the same cached data."""
+        if self.reuse_search_prefixes and term:
+            return _fold(term)
+        return term
 
-    def get_realtime(self, sid):
+    def get_realtime(self, sid, raise_errors=False):
         """Identical arguments and return value as trafikanten.get_realtime.
         Will call _get_cached_realtime and _cache_realtime to handle caching
         properly. Subclasses probably do not need to override this method."""
-        data = self._get_cached_realtime(sid)
+        return self._lookup(sid, raise_errors, trafikanten.get_realtime,
+                            self._get_cached_realtime, self._cache_realtime)
+
+    def _lookup(self, key, raise_errors, fetch, get_cached, cache,
+                derive=None):
+        """Return cached data for key, or fetch and cache it if there is none.
+        Empty results are cached like any other result, errors are cached as
+        CachedError objects for negative_expiry_time seconds. If derive is
+        given, it's called before fetching to try to build the data from
+        other cached data. It should return a (created, data) tuple, or None
+        if it can't."""
+        data = get_cached(key)
+        if self._expired_error(data):
+            data = None
+        if data == None and derive != None:
+            derived = derive(key)
+            if derived != None:
+                created, data = derived
+                cache(key, data, created)
         if data == None:
-            data = trafikanten.get_realtime(sid)
-            self._cache_realtime(sid, data)
+            try:
+                data = fetch(key, raise_errors=True)
+            except trafikanten.TrafikantenError, e:
+                data = CachedError(e)
+            cache(key, data)
+
+        if isinstance(data, CachedError):
+            if raise_errors:
+                raise data.error
+            return None
 
         return data
 
+    def _expired_error(self, data):
+        """True if data is a cached error older than negative_expiry_time"""
+        return isinstance(data, CachedError) and \
+            time.time() - data.time >= self.negative_expiry_time
+
+    def _search_from_prefix(self, term):
+        """Build the search result for the folded term by keeping the
+        stations whose folded name contains term from the cached result of
+        the longest cached prefix of term. Returns a
+        (created, data) tuple, where created is when the prefix result was
+        cached, or None if no prefix is cached, the result for the prefix
+        may be incomplete, or it's unknown when it was cached."""
+        for end in range(len(term) - 1, 0, -1):
+            entry = self._get_search_entry(term[:end])
+            if entry == None:
+                continue
+            created, data = entry
+            if created == None or isinstance(data, CachedError) or \
+                    len(data) >= self.search_result_limit:
+                return None
+            return created, [e for e in data if term in _fold(e["name"])]
+
+        return None
+
+    def _get_search_entry(self, term):
+        """Like _get_cached_search, but returns a (created, data) tuple where
+        created is the time the data was cached, or None if term is not
+        cached. The default implementation returns None, as it can't tell
+        when the data was cached."""
+        return None
+
+    def _get_realtime_entry(self, sid):
+        """Same as _get_search_entry for realtime data"""
+        return None
+
     def _get_cached_realtime(self, sid):
         """Return cached realtime data for the station sid. If no cached
         data is available, return None"""
@@ -95,70 +212,238 @@ class FileCacheTrafikanten(CachingTrafikanten):
         if self.uses_temp:
             shutil.rmtree(self.cache_location)
 
-    def _get_cached_search(self, term):
-        cachepath = os.path.join(self.cache_location, "search_"+str(hash(term)))
+    def _path(self, kind, key):
+        """The cache file for key. Named by a digest of key, so that all
+        processes sharing the folder agree on the name."""
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return os.path.join(self.cache_location,
+                            kind + "_" + hashlib.md5(key).hexdigest())
+
+    def _read(self, cachepath, expiry_time):
+        """Returns a (created, data) tuple, where created is the mtime of the
+        cache file, or None if there is no fresh data in cachepath"""
         if os.path.isfile(cachepath):
-            age = time.time() - os.stat(cachepath)[stat.ST_MTIME]
-            if age < self.search_expiry_time:
+            created = os.stat(cachepath)[stat.ST_MTIME]
+            if time.time() - created < expiry_time:
                 fp = open(cachepath, "rb")
                 data = pickle.load(fp)
                 fp.close()
-                return data
+                return created, data
 
         return None
 
-    def _cache_search(self, term, data):
-        cachepath = os.path.join(self.cache_location, "search_"+str(hash(term)))
-        fp = open(cachepath, "wb")
+    def _write(self, cachepath, data, created=None):
+        """Write to a temporary file and rename it in place, so other
+        processes sharing the cache folder never see a half written file"""
+        fd, tmppath = tempfile.mkstemp(".tmp", "tf_", self.cache_location)
+        fp = os.fdopen(fd, "wb")
         pickle.dump(data, fp)
         fp.close()
+        os.chmod(tmppath, _file_mode)
+        if created != None:
+            os.utime(tmppath, (created, created))
+        try:
+            os.rename(tmppath, cachepath)
+        except OSError:
+            # windows won't rename over an existing file
+            os.remove(cachepath)
+            os.rename(tmppath, cachepath)
 
-    def _get_cached_realtime(self, sid):
-        cachepath = os.path.join(self.cache_location, "station_"+str(hash(sid)))
-        if os.path.isfile(cachepath):
-            age = time.time() - os.stat(cachepath)[stat.ST_MTIME]
-            if age < self.search_expiry_time:
-                fp = open(cachepath, "rb")
-                data = pickle.load(fp)
-                fp.close()
-                return data
+    def _get_search_entry(self, term):
+        return self._read(self._path("search", term), self.search_expiry_time)
 
+    def _get_cached_search(self, term):
+        entry = self._get_search_entry(term)
+        if entry != None:
+            return entry[1]
         return None
 
-    def _cache_realtime(self, sid, data):
-        cachepath = os.path.join(self.cache_location, "search_"+str(hash(sid)))
-        fp = open(cachepath, "wb")
-        pickle.dump(data, fp)
-        fp.close()
+    def _cache_search(self, term, data, created=None):
+        self._write(self._path("search", term), data, created)
+
+    def _get_realtime_entry(self, sid):
+        return self._read(self._path("station", sid),
+                          self.realtime_expiry_time)
+
+    def _get_cached_realtime(self, sid):
+        entry = self._get_realtime_entry(sid)
+        if entry != None:
+            return entry[1]
+        return None
+
+    def _cache_realtime(self, sid, data, created=None):
+        self._write(self._path("station", sid), data, created)
 
 
 class MemoryCacheTrafikanten(CachingTrafikanten):
     """Caching version of the trafikanten API that ram for caching. It's
-    fairly naive. Expired data is never removed"""
-    def __init__(self, **kwargs):
-        self._search_cache = {}
-        self._realtime_cache =  {}
+    fairly naive. Expired data is only removed when new data is cached. If
+    max_entries is given, the oldest entries are dropped to keep each of the
+    search and realtime caches at no more than max_entries entries."""
+    def __init__(self, max_entries=None, **kwargs):
+        self.max_entries = max_entries
+        self._search_cache = collections.OrderedDict()
+        self._realtime_cache = collections.OrderedDict()
+        self._lock = threading.Lock()
 
         CachingTrafikanten.__init__(self, **kwargs)
 
-    def _get_cached_search(self, term):
-        if term in self._search_cache:
-            age = time.time() - self._search_cache[term][0]
-            if age < self.search_expiry_time:
-                return self._search_cache[term][1]
+    def _store(self, cache, key, data, expiry_time, created):
+        """Store data in cache. Entries are kept in the order they were
+        written, so expired entries, and the entries to drop when the cache
+        is full, are found at the front."""
+        now = time.time()
+        if created == None:
+            created = now
+        with self._lock:
+            cache.pop(key, None)
+            while cache:
+                oldest = cache.itervalues().next()
+                if now - oldest[0] < expiry_time and (self.max_entries == None
+                        or len(cache) < self.max_entries):
+                    break
+                cache.popitem(last=False)
+            cache[key] = (created, data)
+
+    def _get_entry(self, cache, key, expiry_time):
+        entry = cache.get(key)
+        if entry != None and time.time() - entry[0] < expiry_time:
+            return entry
 
         return None
 
-    def _cache_search(self, term, data):
-        self._search_cache[term] = (time.time(), data)
+    def _get_search_entry(self, term):
+        return self._get_entry(self._search_cache, term,
+                               self.search_expiry_time)
 
-    def _get_cached_realtime(self, sid):
-        if sid in self._realtime_cache:
-            age = time.time() - self._search_cache[sid][0]
-            if age < self.search_expiry_time:
-                return self._search_cache[sid][1]
+    def _get_cached_search(self, term):
+        entry = self._get_search_entry(term)
+        if entry != None:
+            return entry[1]
+        return None
 
+    def _cache_search(self, term, data, created=None):
+        self._store(self._search_cache, term, data, self.search_expiry_time,
+                    created)
+
+    def _get_realtime_entry(self, sid):
+        return self._get_entry(self._realtime_cache, sid,
+                               self.realtime_expiry_time)
+
+    def _get_cached_realtime(self, sid):
+        entry = self._get_realtime_entry(sid)
+        if entry != None:
+            return entry[1]
         return None
 
-    def _cache_realtime(self, sid, data):
-        self._realtime_cache[sid] = (time.time(), data)
+    def _cache_realtime(self, sid, data, created=None):
+        self._store(self._realtime_cache, sid, data,
+                    self.realtime_expiry_time, created)
+
+
+def _overrides(obj, name):
+    """True if obj's class overrides the CachingTrafikanten method name"""
+    return getattr(type(obj), name).im_func is not \
+        getattr(CachingTrafikanten, name).im_func
+
+class TieredCacheTrafikanten(CachingTrafikanten):
+    """Caching version of the trafikanten API that puts one cache in front of
+    another. Lookups try l1 first, then l2, copying l2 hits into l1 with the
+    time they were cached in l2, so data never lives longer in l1 than l2
+    would keep it. New data is written to both. Each tier keeps its own
+    expiry times. Any CachingTrafikanten subclass can be used as a tier, but
+    for tiers that don't implement the _get_*_entry methods, the age of the
+    data is unknown, and copies of it start out fresh.
+    By default l2 is a FileCacheTrafikanten in cache_loc, using the
+    search_expiry_time and realtime_expiry_time given, and l1 is a
+    MemoryCacheTrafikanten keeping at most l1_max_entries searches and
+    stations, search results for at most 5 minutes and realtime data for at
+    most 5 seconds. Several processes using the same cache_loc thus share
+    fetched data through the disk, while the keys each process uses most are
+    served from memory.
+    Lookups answered by each tier, and lookups of keys neither tier had,
+    are counted in the stats dict. Probes for search prefixes are not
+    counted, so a search answered from a cached prefix counts as a miss."""
+    def __init__(self, l1=None, l2=None, cache_loc=None, l1_max_entries=1000,
+                 **kwargs):
+        CachingTrafikanten.__init__(self, **kwargs)
+
+        if l1 == None:
+            l1 = MemoryCacheTrafikanten(
+                max_entries=l1_max_entries,
+                search_expiry_time=min(300, self.search_expiry_time),
+                realtime_expiry_time=min(5, self.realtime_expiry_time))
+        if l2 == None:
+            l2 = FileCacheTrafikanten(
+                cache_loc=cache_loc,
+                search_expiry_time=self.search_expiry_time,
+                realtime_expiry_time=self.realtime_expiry_time)
+        self.l1 = l1
+        self.l2 = l2
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0}
+
+    def _tier_entry(self, tier, kind, key):
+        """Get the (created, data) entry for key from tier. created is None
+        if the tier can't tell when the data was cached."""
+        if _overrides(tier, "_get_%s_entry" % kind):
+            return getattr(tier, "_get_%s_entry" % kind)(key)
+
+        data = getattr(tier, "_get_cached_%s" % kind)(key)
+        if data == None:
+            return None
+        return None, data
+
+    def _tier_cache(self, tier, kind, key, data, created):
+        """Cache data in tier, passing created on if the tier takes it"""
+        cache = getattr(tier, "_cache_%s" % kind)
+        if created != None and "created" in inspect.getargspec(cache).args:
+            cache(key, data, created)
+        else:
+            cache(key, data)
+
+    def _get_entry(self, kind, key):
+        """Returns a tuple of the tier that had key and its (created, data)
+        entry, or (None, None) if neither did. Cached errors older than
+        negative_expiry_time count as missing."""
+        entry = self._tier_entry(self.l1, kind, key)
+        if entry != None and not self._expired_error(entry[1]):
+            return "l1", entry
+
+        entry = self._tier_entry(self.l2, kind, key)
+        if entry != None and not self._expired_error(entry[1]):
+            self._tier_cache(self.l1, kind, key, entry[1], entry[0])
+            return "l2", entry
+
+        return None, None
+
+    def _get_cached(self, kind, key):
+        tier, entry = self._get_entry(kind, key)
+        if tier == None:
+            self.stats["misses"] += 1
+            return None
+
+        self.stats[tier + "_hits"] += 1
+        return entry[1]
+
+    def _cache(self, kind, key, data, created):
+        self._tier_cache(self.l2, kind, key, data, created)
+        self._tier_cache(self.l1, kind, key, data, created)
+
+    def _get_search_entry(self, term):
+        return self._get_entry("search", term)[1]
+
+    def _get_cached_search(self, term):
+        return self._get_cached("search", term)
+
+    def _cache_search(self, term, data, created=None):
+        self._cache("search", term, data, created)
+
+    def _get_realtime_entry(self, sid):
+        return self._get_entry("realtime", sid)[1]
+
+    def _get_cached_realtime(self, sid):
+        return self._get_cached("realtime", sid)
+
+    def _cache_realtime(self, sid, data, created=None):
+        self._cache("realtime", sid, data, created)